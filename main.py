@@ -1,26 +1,63 @@
+import time
+SCRIPT_START = time.perf_counter()  # Startup timings are measured from the first run's first line
+
 import streamlit as st
-import cv2
 import numpy as np
-import face_recognition
 import os
-import time
-from datetime import datetime
+import importlib
+import re
+import uuid
+from datetime import datetime, timedelta
 from PIL import Image
-import pandas as pd
 import threading
 import shutil
+import gzip
+
+# Heavy modules (dlib models, OpenCV, pandas) are imported on first use so the
+# UI can render before they load
+class LazyModule:
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, attr)
+
+cv2 = LazyModule("cv2")
+face_recognition = LazyModule("face_recognition")
+pd = LazyModule("pandas")
 
 # Configuration
-KNOWN_FACES_DIR = "students_faces"
-REPORTS_DIR = "session_reports" # <-- NEW: Directory to save session reports
+# Data folders live next to this script, the same place Streamlit serves static/ from
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+KNOWN_FACES_DIR = os.path.join(APP_DIR, "students_faces")
+GALLERY_CACHE_PATH = os.path.join(KNOWN_FACES_DIR, ".gallery_cache.npz")  # Encodings keyed by photo path and mtime
+REPORTS_DIR = os.path.join(APP_DIR, "session_reports") # <-- NEW: Directory to save session reports
 TOLERANCE = 0.5
 FRAME_THICKNESS = 2
 FONT_THICKNESS = 1
 RESIZE_SCALE = 0.25
 SESSION_DURATION = 45 * 60  # 45 minutes in seconds
+EXPORTS_DIR = os.path.join(APP_DIR, "static", "exports")
+EXPORT_CHUNK_ROWS = 50_000  # Rows read per chunk when previewing or exporting history
+EXPORT_RETENTION = 10 * 60  # Exports are downloadable by URL, so delete them after ten minutes
+HISTORY_PREVIEW_ROWS = 1000
+REPORT_COLUMNS = [
+    "Student ID", "Name", "Session Start Time", "Session End Time",
+    "Student Class Entering Time", "Student Last Seen Time", "Student Check Out Time",
+    "Total Time (seconds)", "Total Time (minutes)", "Performance", "Status", "Session Date",
+]
+EXPORT_FORMATS = {"CSV": ".csv", "CSV (gzip)": ".csv.gz", "Parquet": ".parquet"}
+# Classroom sessions are threads in the server process and dlib's detector and encoder
+# hold the GIL, so running several recognitions at once would only interleave them.
+# Sessions therefore take turns on a single slot.
+MAX_CONCURRENT_RECOGNITIONS = 1
+DEFAULT_CPU_QUOTA = 0.5  # Approximate share of one CPU core a single classroom session may use
 
 # Create necessary directories if they don't exist
-for dir_path in [KNOWN_FACES_DIR, REPORTS_DIR]:
+for dir_path in [KNOWN_FACES_DIR, REPORTS_DIR, EXPORTS_DIR]:
     if not os.path.exists(dir_path):
         os.makedirs(dir_path, exist_ok=True)
 
@@ -51,52 +88,253 @@ def init_session_state():
         st.session_state.show_history = False
     if "show_student_management" not in st.session_state:
         st.session_state.show_student_management = False
+    if "show_classrooms" not in st.session_state:
+        st.session_state.show_classrooms = False
+    # Roster the current session is scoped to (None means all students)
+    if "session_roster" not in st.session_state:
+        st.session_state.session_roster = None
+    if "flag_unexpected" not in st.session_state:
+        st.session_state.flag_unexpected = True
 
-# Load Known Students (cached for performance)
-@st.cache_data
-def load_known_faces():
-    st.session_state.known_students = {}
-    for folder in os.listdir(KNOWN_FACES_DIR):
-        folder_path = os.path.join(KNOWN_FACES_DIR, folder)
-        if not os.path.isdir(folder_path):
-            continue
-        parts = folder.split("_")
-        student_id = parts[0]
-        name = " ".join(parts[1:]) if len(parts) > 1 else student_id
-        
-        for img_file in os.listdir(folder_path):
-            if img_file.lower().endswith((".jpg", ".jpeg", ".png")):
+# Read the details saved next to a student's photo at registration
+def read_student_info(student_dir):
+    info = {"courses": []}
+    info_path = os.path.join(student_dir, "info.txt")
+    if not os.path.exists(info_path):
+        return info
+    with open(info_path) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            key, value = key.strip().lower(), value.strip()
+            if key == "courses":
+                info["courses"] = [c.strip() for c in value.split(",") if c.strip()]
+            elif key:
+                info[key] = value
+    return info
+
+# Rewrite the Courses line of info.txt, keeping the other details (creates the file if missing)
+def write_student_courses(student_dir, student_id, student_name, courses):
+    info_path = os.path.join(student_dir, "info.txt")
+    lines = []
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            lines = [line for line in f if line.partition(":")[0].strip().lower() != "courses"]
+    else:
+        lines = [f"ID: {student_id}\n", f"Name: {student_name}\n"]
+    lines.append(f"Courses: {', '.join(courses)}\n")
+    with open(info_path, "w") as f:
+        f.writelines(lines)
+
+def get_course_rosters(known_students):
+    """Maps each course/section code to the IDs of the students enrolled in it."""
+    rosters = {}
+    for student_id, data in known_students.items():
+        for course in data.get("courses", []):
+            rosters.setdefault(course, []).append(student_id)
+    return rosters
+
+# Encodings cache: plain arrays only (never pickle), since students_faces/ holds uploads
+def load_gallery_cache():
+    """Returns {photo path: (mtime, encoding or None)} from GALLERY_CACHE_PATH, or {} if unreadable."""
+    try:
+        with np.load(GALLERY_CACHE_PATH, allow_pickle=False) as data:
+            paths, mtimes = data["paths"], data["mtimes"]
+            has_encoding, encodings = data["has_encoding"], data["encodings"]
+            return {
+                str(path): (float(mtime), encoding if found else None)
+                for path, mtime, found, encoding in zip(paths, mtimes, has_encoding, encodings)
+            }
+    except Exception:
+        return {}
+
+def save_gallery_cache(cache):
+    paths = list(cache)
+    encodings = np.zeros((len(paths), 128), dtype=np.float64)
+    has_encoding = np.zeros(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        if cache[path][1] is not None:
+            encodings[i] = cache[path][1]
+            has_encoding[i] = True
+    tmp_path = GALLERY_CACHE_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            paths=np.array(paths, dtype=str),
+            mtimes=np.array([cache[path][0] for path in paths], dtype=np.float64),
+            has_encoding=has_encoding,
+            encodings=encodings,
+        )
+    os.replace(tmp_path, GALLERY_CACHE_PATH)
+
+# Background loader: warms up the models and builds the gallery off the UI thread
+class GalleryLoader:
+    """
+    Imports the recognition models and encodes every student photo in a background
+    thread, reusing cached encodings for photos that have not changed. The last
+    complete gallery stays available in known_students while a reload runs.
+    Also records how long the app took to first render and to become ready,
+    both measured from `started`.
+    """
+    def __init__(self, started):
+        self.started = started
+        self.first_render_seconds = None
+        self.ready_seconds = None
+        self.known_students = {}
+        self.errors = []
+        self.progress = 0.0
+        self.stage = "Starting"
+        self.loading = False
+        self._reload_pending = False
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        with self._lock:
+            if self.loading:
+                # Students changed mid-load; load again once the current pass finishes
+                self._reload_pending = True
+                return
+            self.loading = True
+        threading.Thread(target=self._load, daemon=True).start()
+
+    def mark_first_render(self):
+        if self.first_render_seconds is None:
+            self.first_render_seconds = time.perf_counter() - self.started
+            print(f"Startup: first render after {self.first_render_seconds:.2f}s")
+
+    def _load(self):
+        while True:
+            self._build_gallery()
+            with self._lock:
+                if not self._reload_pending:
+                    self.loading = False
+                    return
+                self._reload_pending = False
+
+    def _build_gallery(self):
+        try:
+            self.stage, self.progress = "Loading recognition models...", 0.0
+            importlib.import_module("face_recognition")  # Loads dlib and its models
+            importlib.import_module("cv2")
+
+            cache = load_gallery_cache()
+
+            photos = []
+            for folder in sorted(os.listdir(KNOWN_FACES_DIR)):
+                folder_path = os.path.join(KNOWN_FACES_DIR, folder)
+                if not os.path.isdir(folder_path):
+                    continue
+                for img_file in os.listdir(folder_path):
+                    if img_file.lower().endswith((".jpg", ".jpeg", ".png")):
+                        photos.append((folder, folder_path, img_file))
+
+            known_students, errors, new_cache = {}, [], {}
+            for done, (folder, folder_path, img_file) in enumerate(photos, start=1):
+                self.stage = f"Encoding student photos ({done}/{len(photos)})..."
+                parts = folder.split("_")
+                student_id = parts[0]
+                name = " ".join(parts[1:]) if len(parts) > 1 else student_id
                 img_path = os.path.join(folder_path, img_file)
                 try:
-                    image = face_recognition.load_image_file(img_path)
-                    encodings = face_recognition.face_encodings(image)
-                    if encodings:
-                        if student_id not in st.session_state.known_students:
-                            st.session_state.known_students[student_id] = {"name": name, "encodings": []}
-                        st.session_state.known_students[student_id]["encodings"].append(encodings[0])
+                    mtime = os.path.getmtime(img_path)
+                    if img_path in cache and cache[img_path][0] == mtime:
+                        encoding = cache[img_path][1]
+                    else:
+                        image = face_recognition.load_image_file(img_path)
+                        encodings = face_recognition.face_encodings(image)
+                        encoding = encodings[0] if encodings else None
+                    new_cache[img_path] = (mtime, encoding)
+                    if encoding is not None:
+                        if student_id not in known_students:
+                            courses = read_student_info(folder_path)["courses"]
+                            known_students[student_id] = {"name": name, "encodings": [], "courses": courses}
+                        known_students[student_id]["encodings"].append(encoding)
                 except Exception as e:
-                    st.error(f"Error processing {img_file} in {folder}: {e}")
+                    errors.append(f"Error processing {img_file} in {folder}: {e}")
+                self.progress = done / len(photos)
+
+            try:
+                save_gallery_cache(new_cache)
+            except Exception as e:
+                print(f"Could not save gallery cache: {e}")
+
+            self.known_students, self.errors = known_students, errors
+            if self.ready_seconds is None:
+                self.ready_seconds = time.perf_counter() - self.started
+                print(f"Startup: ready after {self.ready_seconds:.2f}s ({len(known_students)} students)")
+        except Exception as e:
+            self.errors = [f"Error loading students: {e}"]
+            print(f"Error in gallery loader thread: {e}")
+        finally:
+            self.stage, self.progress = "Done", 1.0
+
+# One loader per server process, started by the first page view. It is created
+# during the first script run, so SCRIPT_START here is that run's first line.
+@st.cache_resource
+def get_gallery_loader():
+    return GalleryLoader(SCRIPT_START)
+
+def reload_known_faces():
+    get_gallery_loader().reload()
+
+def gallery_status():
+    """Shows loading progress; once loading finishes, reruns the app so every page sees the students."""
+    loader = get_gallery_loader()
+    if loader.loading:
+        st.session_state.gallery_loading = True
+        st.progress(loader.progress, text=loader.stage)
+    elif st.session_state.get("gallery_loading"):
+        st.session_state.gallery_loading = False
+        st.rerun()
+
+# Load Known Students (from the background loader, never blocking the page)
+def load_known_faces():
+    loader = get_gallery_loader()
+    st.session_state.known_students = loader.known_students
+    for error in loader.errors:
+        st.error(error)
+
+    # Poll for progress only while loading, so live sessions are not interrupted
+    st.fragment(gallery_status, run_every=0.5 if loader.loading else None)()
     
     # This message now appears in the sidebar after loading
-    if 'known_students' in st.session_state and st.session_state.known_students:
+    if st.session_state.known_students:
         st.sidebar.success(f"Loaded {len(st.session_state.known_students)} students.")
+    if loader.ready_seconds is not None and loader.first_render_seconds is not None:
+        st.sidebar.caption(
+            f"Startup: first render {loader.first_render_seconds:.1f}s, ready {loader.ready_seconds:.1f}s"
+        )
 
 # StudentTracker Class (handles the logic for tracking presence)
 class StudentTracker:
-    # ... (No changes needed in this class)
-    def __init__(self):
+    def __init__(self, known_students=None, session_start=None):
+        # Defaults keep the single-session page working off st.session_state;
+        # classroom sessions pass their own roster and start time.
+        if known_students is None:
+            known_students = st.session_state.known_students
+        self.session_start = session_start
         self.students = {}
-        for student_id, student_data in st.session_state.known_students.items():
-            self.students[student_id] = {
-                "name": student_data["name"],
-                "in_frame": False,
-                "start_time": None,
-                "total_time": 0.0,
-                "first_seen": None,
-                "last_seen": None,
-                "time_in": None,
-                "time_out": None,
-            }
+        for student_id, student_data in known_students.items():
+            self.students[student_id] = self._new_entry(student_data["name"])
+
+    @staticmethod
+    def _new_entry(name, unexpected=False):
+        return {
+            "name": name,
+            "in_frame": False,
+            "start_time": None,
+            "total_time": 0.0,
+            "first_seen": None,
+            "last_seen": None,
+            "time_in": None,
+            "time_out": None,
+            "unexpected": unexpected,
+        }
+
+    def add_unexpected(self, student_id, name):
+        """Starts tracking a recognised student who is not on this session's roster."""
+        if student_id not in self.students:
+            self.students[student_id] = self._new_entry(name, unexpected=True)
     
     def update_presence(self, student_id, in_frame, current_time):
         student = self.students.get(student_id)
@@ -125,7 +363,7 @@ class StudentTracker:
                 data["time_out"] = datetime.fromtimestamp(current_time).strftime("%H:%M:%S")
     
     def get_csv_data(self):
-        session_start = st.session_state.session_start
+        session_start = self.session_start or st.session_state.session_start
         session_end = time.time()
         session_start_dt = datetime.fromtimestamp(session_start)
         session_date = session_start_dt.strftime("%Y-%m-%d")
@@ -148,6 +386,8 @@ class StudentTracker:
                 elif time_ratio >= 0.25: performance = "Good"
                 else: performance = "Poor"
                 status = "Present"
+            if info.get("unexpected"):
+                status = "Unexpected Attendee"
             
             data.append({
                 "Student ID": student_id, "Name": info["name"],
@@ -179,6 +419,277 @@ def session_timer():
     except Exception as e:
         print(f"Error in session timer thread: {e}")
 
+# Shared gallery: every registered encoding packed into one read-only matrix
+class SharedGallery:
+    """
+    Holds the face encodings of all students in a single read-only array. Classroom
+    sessions are threads in the server process, so they all match against this one
+    in-process copy by reference; no shared memory is involved.
+    """
+    def __init__(self, known_students):
+        self.names = {sid: data["name"] for sid, data in known_students.items()}
+        self.row_ids = [sid for sid, data in known_students.items() for _ in data["encodings"]]
+        rows = [enc for data in known_students.values() for enc in data["encodings"]]
+        self.encodings = np.array(rows, dtype=np.float64).reshape(len(rows), 128)
+        self.encodings.setflags(write=False)
+
+    def match(self, encoding, tolerance):
+        """Returns (student_id, name) of the closest encoding within tolerance, else ("Unknown", "Unknown")."""
+        if not self.row_ids:
+            return "Unknown", "Unknown"
+        distances = np.linalg.norm(self.encodings - encoding, axis=1)
+        best = int(np.argmin(distances))
+        if distances[best] < tolerance:
+            student_id = self.row_ids[best]
+            return student_id, self.names[student_id]
+        return "Unknown", "Unknown"
+
+    def view(self, student_ids, fallback=False):
+        return GalleryView(self, student_ids, fallback)
+
+class GalleryView(SharedGallery):
+    """
+    A roster-sized copy of a SharedGallery's rows, so a session only matches against
+    its own students. With fallback=True, faces that match nobody on the roster are
+    searched for in the full gallery; callers flag those hits as unexpected attendees.
+    """
+    def __init__(self, gallery, student_ids, fallback=False):
+        wanted = set(student_ids)
+        rows = [i for i, sid in enumerate(gallery.row_ids) if sid in wanted]
+        self.names = {sid: name for sid, name in gallery.names.items() if sid in wanted}
+        self.row_ids = [gallery.row_ids[i] for i in rows]
+        self.encodings = gallery.encodings[rows]
+        self.encodings.setflags(write=False)
+        self.full_gallery = gallery if fallback else None
+
+    def match(self, encoding, tolerance):
+        student_id, name = super().match(encoding, tolerance)
+        if student_id == "Unknown" and self.full_gallery is not None:
+            return self.full_gallery.match(encoding, tolerance)
+        return student_id, name
+
+def recognize_faces(frame, gallery, tolerance):
+    """
+    Detects faces in a BGR frame and matches each one against the gallery.
+
+    Returns:
+        list: (student_id, name, (top, right, bottom, left)) per face, in full-frame coordinates.
+    """
+    small_frame = cv2.resize(frame, (0, 0), fx=RESIZE_SCALE, fy=RESIZE_SCALE)
+    rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+    face_locations = face_recognition.face_locations(rgb_small_frame)
+    face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+    matches = []
+    for encoding, location in zip(face_encodings, face_locations):
+        student_id, name = gallery.match(encoding, tolerance)
+        matches.append((student_id, name, tuple(int(v / RESIZE_SCALE) for v in location)))
+    return matches
+
+def save_session_report(csv_data, session_id=None):
+    """Writes a finished session's rows into REPORTS_DIR and returns the file path."""
+    prefix = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if session_id:
+        # Classroom names are free text; keep only filename-safe characters
+        safe_id = re.sub(r"[^A-Za-z0-9_-]+", "-", session_id).strip("-")
+        if safe_id:
+            prefix += f"_{safe_id}"
+    save_path = os.path.join(REPORTS_DIR, f"{prefix}_classroomReport.csv")
+    pd.DataFrame(csv_data).to_csv(save_path, index=False)
+    return save_path
+
+# Global scheduler: divides recognition capacity fairly between classroom sessions
+class RecognitionScheduler:
+    """
+    Hands out recognition slots strictly in arrival order, at most `capacity` at a
+    time. Each session asks for one slot per frame, so sessions take turns
+    round-robin and a busy classroom cannot starve the others. Sessions are
+    threads in one process, so see MAX_CONCURRENT_RECOGNITIONS before raising
+    the capacity.
+    """
+    def __init__(self, capacity=MAX_CONCURRENT_RECOGNITIONS):
+        self.capacity = max(1, int(capacity))
+        self._cond = threading.Condition()
+        self._counters = [0, 0, 0]  # next ticket, now serving, active slots
+
+    def acquire(self):
+        with self._cond:
+            ticket = self._counters[0]
+            self._counters[0] += 1
+            while ticket != self._counters[1] or self._counters[2] >= self.capacity:
+                self._cond.wait()
+            self._counters[1] += 1
+            self._counters[2] += 1
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._counters[2] -= 1
+            self._cond.notify_all()
+
+class ClassroomSession:
+    """
+    One classroom: its own camera source, roster, duration, tolerance and CPU quota.
+
+    The quota is enforced approximately. Only the session thread's own CPU time
+    (time.thread_time) is counted. Work done by OpenCV's internal worker threads
+    and by capture/decode threads is not, so real usage can exceed the quota.
+    """
+    def __init__(self, session_id, source=0, roster=None, duration=SESSION_DURATION,
+                 tolerance=TOLERANCE, cpu_quota=DEFAULT_CPU_QUOTA, flag_unexpected=False):
+        self.session_id = session_id
+        self.source = int(source) if str(source).isdigit() else source
+        self.roster = list(roster) if roster else None
+        self.flag_unexpected = flag_unexpected
+        self.duration = duration
+        self.tolerance = tolerance
+        self.cpu_quota = min(1.0, max(0.05, cpu_quota))
+        self.session_start = None
+        self.tracker = None
+        self.csv_data = None
+        self.report_path = None
+        self.error = None
+
+    @property
+    def remaining_time(self):
+        if self.session_start is None:
+            return self.duration
+        return max(0, int(self.session_start + self.duration - time.time()))
+
+    def run(self, gallery, scheduler, stop_event):
+        """Tracks the classroom until the duration runs out or stop_event is set, then saves its report if any frame was captured."""
+        roster = self.roster or list(gallery.names)
+        if self.roster:
+            gallery = gallery.view(self.roster, fallback=self.flag_unexpected)
+        self.tracker = StudentTracker(
+            {sid: {"name": gallery.names[sid]} for sid in roster if sid in gallery.names},
+            self.session_start,
+        )
+        cap = cv2.VideoCapture(self.source)
+        frames_captured = 0
+        try:
+            if not cap.isOpened():
+                self.error = f"Could not open camera source '{self.source}'."
+                return
+            deadline = self.session_start + self.duration
+            while not stop_event.is_set() and time.time() < deadline and cap.isOpened():
+                ret, frame = cap.read()
+                if not ret:
+                    self.error = "Failed to capture video feed."
+                    break
+                frames_captured += 1
+                cpu_start, wall_start = time.thread_time(), time.monotonic()
+                scheduler.acquire()
+                try:
+                    matches = recognize_faces(frame, gallery, self.tolerance)
+                finally:
+                    scheduler.release()
+                present = set()
+                for sid, name, _ in matches:
+                    if sid != "Unknown":
+                        # Without a roster there is nobody to be unexpected
+                        if self.roster:
+                            self.tracker.add_unexpected(sid, name)
+                        present.add(sid)
+                current_time = time.time()
+                for sid in self.tracker.students:
+                    self.tracker.update_presence(sid, sid in present, current_time)
+                # Idle long enough that CPU time / wall time stays within the quota
+                idle = (time.thread_time() - cpu_start) / self.cpu_quota - (time.monotonic() - wall_start)
+                if idle > 0:
+                    stop_event.wait(idle)
+        except Exception as e:
+            self.error = str(e)
+            print(f"Error in classroom session {self.session_id}: {e}")
+        finally:
+            cap.release()
+            self.tracker.final_update(time.time())
+            # A session that never saw a frame has nothing to report
+            if frames_captured:
+                self.csv_data = self.tracker.get_csv_data()
+                try:
+                    self.report_path = save_session_report(self.csv_data, self.session_id)
+                except Exception as e:
+                    self.error = f"Failed to save session report: {e}"
+                    print(f"Error saving report for classroom session {self.session_id}: {e}")
+
+class SessionManager:
+    """
+    Runs many independent classroom sessions in this process, one thread each.
+    All sessions share one read-only gallery and one scheduler. One manager is
+    shared by every browser tab, so check-then-act sections hold _lock.
+    """
+    def __init__(self, capacity=MAX_CONCURRENT_RECOGNITIONS):
+        self.scheduler = RecognitionScheduler(capacity)
+        self.gallery = SharedGallery({})
+        self.sessions = {}
+        self._workers = {}
+        self._stop_events = {}
+        self._lock = threading.RLock()
+
+    def set_gallery(self, known_students):
+        """Replaces the shared gallery; only allowed while no session is using it."""
+        with self._lock:
+            if self.running_sessions():
+                raise RuntimeError("Cannot reload students while classroom sessions are running.")
+            self.gallery = SharedGallery(known_students)
+
+    def start_session(self, session_id, **options):
+        with self._lock:
+            if self.is_running(session_id):
+                raise ValueError(f"Session '{session_id}' is already running.")
+            missing = [sid for sid in options.get("roster") or [] if sid not in self.gallery.names]
+            if missing:
+                raise ValueError(
+                    f"Students not loaded for classroom sessions yet: {', '.join(missing)}. "
+                    "They can be added once all running sessions have ended."
+                )
+            session = ClassroomSession(session_id, **options)
+            session.session_start = time.time()
+            stop_event = threading.Event()
+            worker = threading.Thread(target=session.run, args=(self.gallery, self.scheduler, stop_event), daemon=True)
+            self.sessions[session_id] = session
+            self._workers[session_id] = worker
+            self._stop_events[session_id] = stop_event
+            worker.start()
+            return session
+
+    def is_running(self, session_id):
+        worker = self._workers.get(session_id)
+        return worker is not None and worker.is_alive()
+
+    def is_stopping(self, session_id):
+        stop_event = self._stop_events.get(session_id)
+        return self.is_running(session_id) and stop_event is not None and stop_event.is_set()
+
+    def running_sessions(self):
+        with self._lock:
+            return [sid for sid in self.sessions if self.is_running(sid)]
+
+    def stop_session(self, session_id):
+        """Asks the session to end; it saves its report in its own thread shortly after."""
+        with self._lock:
+            if session_id in self._stop_events:
+                self._stop_events[session_id].set()
+            return self.sessions.get(session_id)
+
+    def remove_session(self, session_id):
+        with self._lock:
+            if self.is_running(session_id):
+                raise RuntimeError(f"Session '{session_id}' is still running.")
+            self.sessions.pop(session_id, None)
+            self._workers.pop(session_id, None)
+            self._stop_events.pop(session_id, None)
+
+    def shutdown(self):
+        with self._lock:
+            for session_id in list(self.sessions):
+                self.stop_session(session_id)
+
+# One manager per server process, shared by every browser tab
+@st.cache_resource
+def get_session_manager():
+    return SessionManager()
+
 # <-- MODIFIED: Student registration form now uses file upload
 def registration_form():
     st.subheader("Register New Student")
@@ -186,6 +697,10 @@ def registration_form():
         student_id = st.text_input("Student ID (must be unique)")
         student_name = st.text_input("Full Name")
         contact_no = st.text_input("Contact Number (Optional)")
+        courses = st.text_input(
+            "Courses / Sections (Optional, comma-separated)",
+            help="e.g. CS101-A, MATH200-B. Sessions can be limited to one course roster."
+        )
         
         # <-- MODIFIED: Replaced camera_input with file_uploader
         uploaded_photo = st.file_uploader(
@@ -214,48 +729,179 @@ def registration_form():
 
                 info_path = os.path.join(student_dir, "info.txt")
                 with open(info_path, "w") as f:
-                    f.write(f"ID: {student_id}\nName: {student_name}\nContact: {contact_no}\n")
+                    f.write(f"ID: {student_id}\nName: {student_name}\nContact: {contact_no}\nCourses: {courses}\n")
                 
                 st.success(f"Student '{student_name}' registered successfully!")
-                load_known_faces.clear()
+                reload_known_faces()
                 st.session_state.show_registration_form = False
                 st.rerun()
             except Exception as e:
                 st.error(f"Failed to save image: {e}")
 
-# <-- NEW: Function to display attendance history
+# Report files whose timestamped name falls outside the date range are skipped unread.
+# The name carries the save time (session end) while rows are filtered on Session Date
+# (session start), so a report saved the day after end_date may still hold matching rows.
+def list_report_files(start_date=None, end_date=None):
+    report_files = []
+    for f in sorted(os.listdir(REPORTS_DIR)):
+        if not f.endswith('.csv'):
+            continue
+        try:
+            file_date = datetime.strptime(f[:8], "%Y%m%d").date()
+        except ValueError:
+            file_date = None
+        if file_date and ((start_date and file_date < start_date) or (end_date and file_date > end_date + timedelta(days=1))):
+            continue
+        report_files.append(os.path.join(REPORTS_DIR, f))
+    return report_files
+
+def iter_report_chunks(start_date=None, end_date=None, student_ids=None, statuses=None, chunksize=EXPORT_CHUNK_ROWS):
+    """
+    Yields the saved session reports as filtered DataFrame chunks of at most
+    `chunksize` rows, so memory use does not grow with the size of the history.
+    """
+    numeric_columns = {"Total Time (seconds)", "Total Time (minutes)"}
+    dtypes = {col: float if col in numeric_columns else str for col in REPORT_COLUMNS}
+    for path in list_report_files(start_date, end_date):
+        for chunk in pd.read_csv(path, chunksize=chunksize, dtype=dtypes):
+            chunk = chunk.reindex(columns=REPORT_COLUMNS)
+            if start_date or end_date:
+                dates = pd.to_datetime(chunk["Session Date"], errors="coerce")
+                in_range = pd.Series(True, index=chunk.index)
+                if start_date:
+                    in_range &= dates >= pd.Timestamp(start_date)
+                if end_date:
+                    in_range &= dates <= pd.Timestamp(end_date)
+                chunk = chunk[in_range]
+            if student_ids:
+                chunk = chunk[chunk["Student ID"].isin(student_ids)]
+            if statuses:
+                chunk = chunk[chunk["Status"].isin(statuses)]
+            if not chunk.empty:
+                yield chunk
+
+def remove_expired_exports():
+    now = time.time()
+    for f in os.listdir(EXPORTS_DIR):
+        old_path = os.path.join(EXPORTS_DIR, f)
+        if os.path.isfile(old_path) and now - os.path.getmtime(old_path) > EXPORT_RETENTION:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass  # Already removed by another session
+
+def export_attendance_history(export_format, **filters):
+    """
+    Writes the filtered history to a file in EXPORTS_DIR one chunk at a time and
+    returns its path, or None if nothing matched.
+    """
+    remove_expired_exports()
+
+    # The random token keeps the public URL unguessable and concurrent exports apart
+    file_name = f"{uuid.uuid4().hex}_attendance_history{EXPORT_FORMATS[export_format]}"
+    export_path = os.path.join(EXPORTS_DIR, file_name)
+    rows_written = 0
+
+    if export_format == "Parquet":
+        import pyarrow as pa  # Installed with streamlit
+        import pyarrow.parquet as pq
+        schema = pa.schema([
+            (col, pa.float64() if col.startswith("Total Time") else pa.string()) for col in REPORT_COLUMNS
+        ])
+        with pq.ParquetWriter(export_path, schema) as writer:
+            for chunk in iter_report_chunks(**filters):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                rows_written += len(chunk)
+    else:
+        opener = gzip.open if export_format == "CSV (gzip)" else open
+        with opener(export_path, "wt", newline="", encoding="utf-8") as f:
+            for chunk in iter_report_chunks(**filters):
+                chunk.to_csv(f, index=False, header=rows_written == 0)
+                rows_written += len(chunk)
+
+    if rows_written == 0:
+        os.remove(export_path)
+        return None
+    return export_path
+
+# <-- MODIFIED: History is previewed and exported in chunks instead of loaded all at once
 def display_attendance_history():
     st.header("📜 Attendance History")
+    remove_expired_exports()
     
-    report_files = [f for f in os.listdir(REPORTS_DIR) if f.endswith('.csv')]
-    
-    if not report_files:
+    if not list_report_files():
         st.warning("No past session reports found.")
         return
 
-    all_reports_df = pd.DataFrame()
+    # Filters are applied while reading, before any rows are kept in memory
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        date_range = st.date_input("Session Dates", value=())
+    with col2:
+        known_students = st.session_state.known_students
+        student_ids = st.multiselect(
+            "Students",
+            options=list(known_students),
+            format_func=lambda sid: f"{known_students[sid]['name']} ({sid})",
+        )
+    with col3:
+        statuses = st.multiselect("Status", options=["Present", "Absent", "Unexpected Attendee"])
+    filters = {
+        "start_date": date_range[0] if len(date_range) > 0 else None,
+        "end_date": date_range[1] if len(date_range) > 1 else None,
+        "student_ids": student_ids,
+        "statuses": statuses,
+    }
+
+    preview = []
+    preview_rows = 0
     try:
-        df_list = [pd.read_csv(os.path.join(REPORTS_DIR, f)) for f in report_files]
-        if df_list:
-            all_reports_df = pd.concat(df_list, ignore_index=True)
+        for chunk in iter_report_chunks(chunksize=HISTORY_PREVIEW_ROWS, **filters):
+            preview.append(chunk.head(HISTORY_PREVIEW_ROWS - preview_rows))
+            preview_rows += len(preview[-1])
+            if preview_rows >= HISTORY_PREVIEW_ROWS:
+                break
     except Exception as e:
         st.error(f"Error loading report files: {e}")
         return
 
-    if all_reports_df.empty:
+    if not preview:
         st.info("No attendance data to show yet.")
         return
         
-    st.dataframe(all_reports_df)
+    st.dataframe(pd.concat(preview, ignore_index=True))
+    if preview_rows >= HISTORY_PREVIEW_ROWS:
+        st.caption(f"Showing the first {HISTORY_PREVIEW_ROWS} matching rows. Export to get all of them.")
     
-    # Allow downloading the consolidated report
-    csv_data = all_reports_df.to_csv(index=False).encode('utf-8')
-    st.download_button(
-        label="Download Full History as CSV",
-        data=csv_data,
-        file_name="full_attendance_history.csv",
-        mime="text/csv"
-    )
+    # Exports are streamed to disk and served as static files instead of held in memory
+    export_format = st.selectbox("Export Format", list(EXPORT_FORMATS))
+    if st.button("Export Filtered History"):
+        # .streamlit/config.toml is only read from the working directory, so the
+        # download link would 404 if the app was started from somewhere else
+        if not st.get_option("server.enableStaticServing"):
+            st.error(
+                "Static file serving is off, so exports cannot be downloaded. Start the app from its own "
+                "folder or run it with `--server.enableStaticServing true`."
+            )
+            return
+        try:
+            export_path = export_attendance_history(export_format, **filters)
+        except Exception as e:
+            st.error(f"Error exporting history: {e}")
+            return
+        if export_path:
+            file_name = os.path.basename(export_path)
+            download_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file_name.split('_', 1)[1]}"
+            st.markdown(
+                f'<a href="app/static/exports/{file_name}" download="{download_name}">⬇️ Download {download_name}</a>',
+                unsafe_allow_html=True,
+            )
+            st.caption(
+                f"This file contains student names, IDs and attendance times. Anyone who has the link "
+                f"can download it without logging in until it expires in {EXPORT_RETENTION // 60} minutes."
+            )
+        else:
+            st.info("No rows match the selected filters.")
 
 # Main Application
 def main():
@@ -376,15 +1022,28 @@ def main():
 
         
         if st.button("Reload Students List", use_container_width=True):
-            load_known_faces.clear()
+            reload_known_faces()
         
         load_known_faces() # Load faces and display count in sidebar
         st.divider()
 
         st.subheader("Session Control")
+        course_rosters = get_course_rosters(st.session_state.known_students)
+        course = st.selectbox("Course Roster", ["All Students"] + sorted(course_rosters), disabled=is_running)
+        flag_unexpected = st.checkbox(
+            "Flag unexpected attendees",
+            value=True,
+            disabled=is_running or course == "All Students",
+            help="Also search the full student list for faces not on the course roster."
+        )
         if not st.session_state.is_running:
             if st.button("Start Classroom Session", use_container_width=True, disabled=not st.session_state.known_students):
-                st.session_state.tracker = StudentTracker()
+                roster = course_rosters.get(course)
+                st.session_state.session_roster = roster
+                st.session_state.flag_unexpected = flag_unexpected
+                st.session_state.tracker = StudentTracker(
+                    {sid: st.session_state.known_students[sid] for sid in roster} if roster else None
+                )
                 st.session_state.cap = cv2.VideoCapture(0)
                 st.session_state.is_running = True
                 st.session_state.show_registration_form = False
@@ -423,9 +1082,17 @@ def main():
         if st.button("Back to Main Page"):
             st.session_state.show_history = False
             st.rerun()
+
+    elif st.session_state.show_classrooms:
+        display_classrooms_page()
+        if st.button("Back to Main Page"):
+            st.session_state.show_classrooms = False
+            st.rerun()
     else:
         display_main_tracker(TOLERANCE)
 
+    get_gallery_loader().mark_first_render()
+
 def display_live_dashboard(session_start_time):
         """
         This function displays a live dashboard of student attendance during a session.
@@ -450,6 +1117,8 @@ def display_live_dashboard(session_start_time):
             attendance_percentage = min(100, attendance_percentage)
 
             status_text = "✅ In Frame" if data["in_frame"] else "❌ Not in Frame"
+            if data.get("unexpected"):
+                status_text += " | ⚠️ Unexpected attendee"
             
             with st.container():
                 st.write(f"**{data['name']} ({student_id})**")
@@ -459,6 +1128,102 @@ def display_live_dashboard(session_start_time):
 
 
 
+def display_classrooms_page():
+    """
+    Lets several classrooms run at once, each with its own camera source, roster,
+    duration, tolerance and CPU quota. Sessions are threads in the server process
+    that take turns at recognition. They keep running between page reruns and save
+    their report to REPORTS_DIR when they finish.
+    """
+    st.header("🏫 Classroom Sessions")
+    manager = get_session_manager()
+    known_students = st.session_state.known_students
+    # The shared gallery is only rebuilt while no session runs, so until then
+    # only students already in it can be picked
+    if manager.running_sessions():
+        selectable = manager.gallery.names
+    else:
+        selectable = {sid: data["name"] for sid, data in known_students.items()}
+
+    # Outside the form so the student picker appears as soon as "Custom" is chosen
+    course_rosters = get_course_rosters(known_students)
+    course = st.selectbox("Course Roster", ["Custom"] + sorted(course_rosters))
+
+    with st.form(key="classroom_session_form"):
+        session_id = st.text_input("Classroom Name (must be unique)")
+        source = st.text_input("Camera Source (device index, video file or stream URL)", value="0")
+        if course == "Custom":
+            roster = st.multiselect(
+                "Students (leave empty for all students)",
+                options=list(selectable),
+                format_func=lambda sid: f"{selectable[sid]} ({sid})",
+            )
+        else:
+            roster = course_rosters[course]
+            st.caption(f"{len(roster)} students enrolled in {course}.")
+        flag_unexpected = st.checkbox(
+            "Flag unexpected attendees", value=True,
+            help="Also search the full student list for faces not on the roster."
+        )
+        duration_minutes = st.number_input("Session Duration (minutes)", min_value=1, max_value=180, value=45)
+        tolerance = st.slider("Face Recognition Tolerance", min_value=0.30, max_value=0.70, value=0.50, step=0.05)
+        cpu_quota = st.slider(
+            "CPU Quota", min_value=0.10, max_value=1.00, value=DEFAULT_CPU_QUOTA, step=0.05,
+            help="Approximate share of one CPU core this classroom may use for face recognition. "
+                 "CPU used by OpenCV's own capture and decode threads is not counted."
+        )
+        submitted = st.form_submit_button("Start Classroom Session")
+
+        if submitted:
+            if not session_id or not known_students:
+                st.error("Please provide a classroom name and make sure students are loaded.")
+            else:
+                try:
+                    if not manager.running_sessions():
+                        manager.set_gallery(known_students)
+                    manager.start_session(
+                        session_id, source=source, roster=roster,
+                        duration=duration_minutes * 60, tolerance=tolerance, cpu_quota=cpu_quota,
+                        flag_unexpected=flag_unexpected,
+                    )
+                    st.rerun()
+                except (ValueError, RuntimeError) as e:
+                    st.error(str(e))
+
+    if not manager.sessions:
+        st.info("No classroom sessions yet.")
+        return
+
+    for session_id, session in list(manager.sessions.items()):
+        with st.container(border=True):
+            st.subheader(session_id)
+            roster_size = len(session.roster) if session.roster else len(manager.gallery.names)
+            st.write(f"**Source:** {session.source} | **Students:** {roster_size} | **CPU Quota:** {session.cpu_quota:.2f}")
+            if manager.is_stopping(session_id):
+                st.info("Ending session and saving its report... Refresh to see the result.")
+            elif manager.is_running(session_id):
+                mins, secs = divmod(session.remaining_time, 60)
+                st.metric(label="Time Remaining", value=f"{mins:02d}:{secs:02d}")
+                # Only signals the session; the next rerun shows its final state
+                if st.button("End Session Now", key=f"stop_{session_id}", type="primary"):
+                    manager.stop_session(session_id)
+                    st.rerun()
+            else:
+                if session.error:
+                    st.error(session.error)
+                if session.report_path:
+                    st.success(f"Session completed! Report saved to {session.report_path}")
+                if st.button("Remove", key=f"remove_{session_id}"):
+                    try:
+                        manager.remove_session(session_id)
+                        st.rerun()
+                    except RuntimeError as e:
+                        st.error(str(e))
+
+    if st.button("Refresh Sessions"):
+        st.rerun()
+
+
 def display_student_management_page(known_faces_dir):
     """
     Creates a page to view, manage, and delete student profiles.
@@ -497,6 +1262,22 @@ def display_student_management_page(known_faces_dir):
             with col2:
                 st.subheader(f"{student_name}")
                 st.write(f"**Student ID:** {student_id}")
+                courses = read_student_info(student_dir)["courses"]
+                new_courses = st.text_input(
+                    "Courses / Sections (comma-separated)",
+                    value=", ".join(courses),
+                    key=f"courses_{student_id}",
+                )
+                if st.button("Save Courses", key=f"save_courses_{student_id}"):
+                    try:
+                        write_student_courses(
+                            student_dir, student_id, student_name,
+                            [c.strip() for c in new_courses.split(",") if c.strip()],
+                        )
+                        reload_known_faces()
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Error saving courses: {e}")
 
                 # Create a delete button. The 'key' is crucial here!
                 # It must be unique for each button inside a loop.
@@ -507,7 +1288,7 @@ def display_student_management_page(known_faces_dir):
                         st.success(f"Successfully deleted the profile for {student_name}.")
                         
                         # Clear the cached face data and rerun the app to reflect the change
-                        load_known_faces.clear()
+                        reload_known_faces()
                         st.rerun()
                     except Exception as e:
                         st.error(f"Error deleting profile: {e}")
@@ -637,7 +1418,7 @@ def display_main_tracker(tolerance):
     st.markdown("---") # Visual separator
 
     # Display management buttons with icons in columns
-    b1, b2, b3, b4 = st.columns(4)
+    b1, b2, b3, b4, b5 = st.columns(5)
     with b1:
         if st.button("➕ Register Student", use_container_width=True):
             st.session_state.show_registration_form = True
@@ -652,7 +1433,11 @@ def display_main_tracker(tolerance):
             st.rerun()
     with b4:
         if st.button("🔄 Reload Students List", use_container_width=True):
-            load_known_faces.clear()
+            reload_known_faces()
+            st.rerun()
+    with b5:
+        if st.button("🏫 Classrooms", use_container_width=True):
+            st.session_state.show_classrooms = True
             st.rerun()
             
     st.markdown("---")
@@ -669,6 +1454,9 @@ def display_main_tracker(tolerance):
         if st.session_state.is_running:
             # (Your existing camera feed logic remains unchanged here)
             status_text.info("Live camera feed is active.")
+            gallery = SharedGallery(st.session_state.known_students)
+            if st.session_state.session_roster:
+                gallery = gallery.view(st.session_state.session_roster, fallback=st.session_state.flag_unexpected)
             while st.session_state.is_running and st.session_state.cap and st.session_state.cap.isOpened():
                 ret, frame = st.session_state.cap.read()
                 if not ret:
@@ -676,23 +1464,19 @@ def display_main_tracker(tolerance):
                     st.session_state.is_running = False
                     break
                 st.session_state.last_frame = frame.copy()
-                small_frame = cv2.resize(frame, (0, 0), fx=RESIZE_SCALE, fy=RESIZE_SCALE)
-                rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-                face_locations = face_recognition.face_locations(rgb_small_frame)
-                face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
                 if st.session_state.known_students:
+                    matches = recognize_faces(frame, gallery, tolerance)
                     current_presence = {sid: False for sid in st.session_state.tracker.students}
-                    for encoding, location in zip(face_encodings, face_locations):
-                        best_match_id, best_match_name = "Unknown", "Unknown"
-                        best_distance = 1.0
-                        for sid, sdata in st.session_state.known_students.items():
-                            distances = face_recognition.face_distance(sdata["encodings"], encoding)
-                            min_dist = np.min(distances) if distances.size > 0 else 1.0
-                            if min_dist < tolerance and min_dist < best_distance:
-                                best_distance, best_match_id, best_match_name = min_dist, sid, sdata["name"]
+                    for best_match_id, best_match_name, (top, right, bottom, left) in matches:
                         color = (0, 255, 0) if best_match_id != "Unknown" else (0, 0, 255)
-                        if best_match_id != "Unknown": current_presence[best_match_id] = True
-                        top, right, bottom, left = [int(v / RESIZE_SCALE) for v in location]
+                        if best_match_id != "Unknown":
+                            # Without a roster, students loaded mid-session are not unexpected
+                            if st.session_state.session_roster:
+                                st.session_state.tracker.add_unexpected(best_match_id, best_match_name)
+                            current_presence[best_match_id] = True
+                            tracked = st.session_state.tracker.students.get(best_match_id)
+                            if tracked and tracked["unexpected"]:
+                                color = (0, 165, 255)  # Orange: recognised but not on the roster
                         cv2.rectangle(frame, (left, top), (right, bottom), color, FRAME_THICKNESS)
                         label = f"{best_match_name}" + (f" ({best_match_id})" if best_match_id != "Unknown" else "")
                         cv2.putText(frame, label, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, FONT_THICKNESS)